@@ -1,17 +1,25 @@
 import argparse
 import enum
+import hashlib
 import os
 import re
-import shutil
 import sys
 import json
 import logging
-import tempfile
 import zipfile
 
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
 from dataclasses import dataclass, field
-from io import BufferedReader
-from typing import Any
+from io import BytesIO
+from typing import Any, BinaryIO
+
+# orjson is an optional dependency, which speeds up parsing JSON
+try:
+    import orjson
+    _HAS_ORJSON = True
+except ImportError:
+    _HAS_ORJSON = False
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s]: %(message)s")
 logger = logging.getLogger("tt-build")
@@ -25,6 +33,52 @@ TEMP_BUILD_DIR = "temp_build"
 
 IGNORED_EXTENSIONS = [".py", ".md", ".sh", ".pdn", ".xcf"]
 
+# How many JSON files can be waiting to be optimized or written at once
+MAX_PENDING_JSON_FILES = 2 * (os.cpu_count() or 1)
+
+# Matches unquoted values of "key": value pairs, so they can be wrapped in quotes.
+# Matches never span multiple lines.
+_VALUE_QUOTE_RE = re.compile(rb'''
+    ("[^"\n]*"[^\S\n]*:[^\S\n]*)              # "key":
+    ([^"\[{\s][^,}\]"\n]*[a-zA-Z][^,}\]"\s]*) # unquoted value, containing at least one letter
+    ([^\S\n]*[,}])                            # , or } ending the value
+''', re.VERBOSE)
+
+# Matches either a string literal, captured in group 1, or a // comment until the end of the line
+# Unlike the previous character loop, \" escapes inside string literals are honoured
+_COMMENT_RE = re.compile(rb'("(?:\\.|[^"\\\n])*")|//[^\n]*')
+
+# Matches either a string literal or a square bracket
+# Unlike the previous character loop, \" escapes inside string literals are honoured
+_BRACKET_RE = re.compile(rb'"(?:\\.|[^"\\])*"|[\[\]]')
+
+# Matches runs of digits, which might be an integer that does not fit into 64 bits
+_LONG_NUMBER_RE = re.compile(r'[0-9]{19,}')
+
+# Invalid single byte characters and their replacements, applied to JSON in a single pass
+_JSON_TRANSLATE = bytes.maketrans(b";\t\n", b",  ")
+_JSON_DELETE = b"\r"
+# Invalid multi byte UTF-8 characters, which are removed from JSON
+_JSON_BOM = b"\xef\xbb\xbf"
+_JSON_NBSP = b"\xc2\xa0"
+
+def _json_loads(data: str) -> Any:
+    """Parses JSON, using orjson if it is available and it parses the data the same way as json."""
+    # orjson parses integers outside of 64 bits as floats, so leave long numbers to json
+    if _HAS_ORJSON and not _LONG_NUMBER_RE.search(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson is stricter than json, for example it rejects NaN and lone surrogates
+            pass
+    return json.loads(data)
+
+def _json_dumps(data: Any) -> str:
+    """Serializes data to compact JSON."""
+    # orjson is not used here, as it formats some floats differently,
+    # which would make the output depend on whether it is installed
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
 @dataclass
 class Config:
     input_directory: str
@@ -37,89 +91,160 @@ class Config:
     ignored_directories: list[str] = field(default_factory=lambda: ["Redundancy"])
     strict_lua: bool = False
     mute_lua: bool = True
+    # DEFLATE compression level of the archive, from 0 (fastest) to 9 (smallest)
+    compression_level: int = 6
 
-def optimize_json(config: Config, f: BufferedReader) -> str:
+def optimize_json(config: Config, f: BinaryIO) -> str:
     """Returns a string of cleaned JSON of a file."""
-    new_lines: list[str] = []
-    for raw_bytes in f.readlines():
-        try:
-            line = raw_bytes.decode("utf-8")
-        except UnicodeDecodeError as e:
-            logger.exception("Failed decoding", raw_bytes)
-            raise e
-
-        in_str = False
-        if "//" in line:
-            for i, char in enumerate(line):
-                if in_str:
-                    if char == "\\":
-                        continue
-                    elif char == "\"":
-                        in_str = False
-                elif char == "\"":
-                    in_str = True
-                elif char == "/" and i + 1 < len(line) and line[i + 1] == "/":
-                    line = line[0:i]
-                    break
-
-        line = re.sub(r'(\"[^\"]*\"\s*:\s*)([^\"\[{\s][^,}\]\"]*[a-zA-Z][^,}\]\"\s]*)(\s*[,}])', r'\1"\2"\3', line)
-
-        # Remove invalid characters
-        line = line.replace("﻿", "")
-        line = line.replace(";", ",")
-        line = line.replace("\t", " ")
-        line = line.replace("\r", "")
-        line = line.replace("\n", " ")
-        line = line.replace(" ", " ")
-        line = line.replace(" ", "")
-
-        new_lines.append(line)
-
-    # Handle escaping of slashes
+    raw_bytes = f.read()
+
+    # Remove non-breaking spaces first, as whitespace in the bytes regexes below is ASCII only
+    raw_bytes = raw_bytes.replace(_JSON_NBSP, b"")
+
+    # Strip // comments, keeping string literals intact
+    if b"//" in raw_bytes:
+        raw_bytes = _COMMENT_RE.sub(rb"\1", raw_bytes)
+
+    raw_bytes = _VALUE_QUOTE_RE.sub(rb'\1"\2"\3', raw_bytes)
+
+    # Remove the remaining invalid characters
+    raw_bytes = raw_bytes.replace(_JSON_BOM, b"")
+    raw_bytes = raw_bytes.translate(_JSON_TRANSLATE, _JSON_DELETE)
+
+    # Cut off anything after the closing bracket of the top level array
     stack = 0
-    in_str = False
-    full_string = ''.join(new_lines)
-    for i in range(len(full_string)):
-        if in_str:
-            if full_string[i] == "\"":
-                in_str = False
-        elif full_string[i] == "\"":
-            in_str = True
-        elif full_string[i] == "[":
+    for match in _BRACKET_RE.finditer(raw_bytes):
+        token = match.group()
+        if token == b"[":
             stack += 1
-        elif full_string[i] == "]":
+        elif token == b"]":
             stack -= 1
             if stack == 0:
-                full_string = full_string[0:i + 1]
+                raw_bytes = raw_bytes[:match.end()]
                 break
 
+    # Only decode once all the byte level cleanup is done
+    try:
+        full_string = raw_bytes.decode("utf-8")
+    except UnicodeDecodeError as e:
+        logger.exception("Failed decoding JSON file")
+        raise e
+
     # Load data into a list for easier handling
-    data: list[dict[str, Any]] = json.loads(full_string)
+    data: list[dict[str, Any]] = _json_loads(full_string)
 
     for arr_obj in data:
-        obj_keys = list(arr_obj.copy().keys())
         plugin_id: str = arr_obj.get("id", "unknown id")
         logger.debug(f"analysing ID: {plugin_id}")
 
         # Raise exception if privileged tag is detected,
         # as it is deprecated and no longer considered secure
-        if "privileged" in obj_keys:
+        if "privileged" in arr_obj:
             raise Exception(
                 f"Privileged tag detected in plugin {plugin_id}. This tag is deprecated and no longer considered secure." +
                 "Please replace it with \"require privileges\": true."
             )
 
         # Remove strict lua
-        if  "strict lua" in obj_keys:
+        if "strict lua" in arr_obj:
             del arr_obj["strict lua"]
             logger.info(f"{plugin_id}: removed strict lua attribute")
 
         # If any scripts objects are deteced, force add mute lua
-        if "script" in obj_keys or "scripts" in obj_keys:
+        if "script" in arr_obj or "scripts" in arr_obj:
             arr_obj["mute lua"] = True
             logger.info(f"{plugin_id}: muted Lua")
 
-    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+    return _json_dumps(data)
+
+def optimize_json_file(config: Config, src_path: str, data: bytes) -> bytes:
+    """Returns UTF-8 encoded cleaned JSON of the already read contents of a file."""
+    logger.info(f"Optimizing JSON file: {src_path}")
+    # Encoding here keeps that work out of the process writing the archive
+    return optimize_json(config, BytesIO(data)).encode("utf-8")
+
+def _write_contents(zf: zipfile.ZipFile, src_path: str, dst_path: str, contents: str | bytes):
+    """Writes processed contents of a file to the archive, keeping the timestamp and permissions of the source file."""
+    # Without this, the entry would be stamped with the current time and identical builds would differ
+    zinfo = zipfile.ZipInfo.from_file(src_path, dst_path)
+    zf.writestr(zinfo, contents, compress_type=zf.compression, compresslevel=zf.compresslevel)
+
+def write_archive(
+    config: Config,
+    archive_path: str,
+    contents_to_include: list[tuple[str, str, str]],
+    files_to_include: list[tuple[str, str]],
+    json_files_to_optimize: list[tuple[str, str]],
+):
+    """Writes a zip archive of processed contents, files as they are and optimized JSON files."""
+    # Identical JSON files are only optimized once, keyed by a digest of their contents,
+    # as lists of tuples of (source path, path in the archive)
+    paths_by_digest: dict[bytes, list[tuple[str, str]]] = {}
+    for src_path, dst_path in json_files_to_optimize:
+        with open(src_path, mode="rb", buffering=0) as in_file:
+            digest = hashlib.file_digest(in_file, lambda: hashlib.blake2b(digest_size=16)).digest()
+        if digest in paths_by_digest:
+            paths_by_digest[digest].append((src_path, dst_path))
+            logger.info(f"Reusing optimized JSON of an identical file: {src_path}")
+            continue
+        paths_by_digest[digest] = [(src_path, dst_path)]
+    unique_json_files = iter(paths_by_digest.values())
+
+    # Open the zip file for writing and add all the files to it, preserving the folder structure
+    with zipfile.ZipFile(
+        archive_path, "w",
+        compression=zipfile.ZIP_DEFLATED, compresslevel=config.compression_level,
+    ) as zf:
+        for src_path, dst_path, contents in contents_to_include:
+            _write_contents(zf, src_path, dst_path, contents)
+            logger.info(f"Added file to archive: {dst_path}")
+
+        # Optimize JSON files in separate processes, as optimizing them is CPU bound.
+        # ZipFile is not thread safe, so only this process writes to the archive.
+        with ProcessPoolExecutor() as executor:
+            # Submitted JSON files in submission order, which keeps the archive entry order stable.
+            # Only a few are submitted at a time, so not every file is held in memory at once.
+            pending: deque[tuple[Future[bytes], list[tuple[str, str]]]] = deque()
+            not_done: set[Future[bytes]] = set()
+
+            def submit_next():
+                paths = next(unique_json_files, None)
+                if paths is None:
+                    return
+                src_path = paths[0][0]
+                # The whole file is read at once, so there is no use for an extra buffer
+                with open(src_path, mode="rb", buffering=0) as in_file:
+                    future = executor.submit(optimize_json_file, config, src_path, in_file.read())
+                pending.append((future, paths))
+                not_done.add(future)
+
+            try:
+                for _ in range(MAX_PENDING_JSON_FILES):
+                    submit_next()
+
+                # Compress the other files while the JSON files are being optimized
+                for src_path, dst_path in files_to_include:
+                    zf.write(filename=src_path, arcname=dst_path)
+                    logger.info(f"Added file to archive: {dst_path}")
+
+                # Write optimized JSON straight into the archive, submitting the next file for each one written
+                while pending:
+                    future, paths = pending.popleft()
+                    # Wait for this file, but fail as soon as optimizing any other file fails
+                    while not future.done():
+                        done, not_done = wait(not_done, return_when=FIRST_COMPLETED)
+                        for completed in done:
+                            _ = completed.result()
+                    not_done.discard(future)
+                    optimized = future.result()
+                    for src_path, dst_path in paths:
+                        _write_contents(zf, src_path, dst_path, optimized)
+                        logger.info(f"Added file to archive: {dst_path}")
+                    submit_next()
+            except BaseException:
+                # Stop the build quickly, without optimizing the queued JSON files for nothing
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
 
 def create_archive(
     config: Config,
@@ -128,44 +253,53 @@ def create_archive(
     # Create archive name based on manifest title and version
     archive_name = f"{manifest['title']} {manifest['version']}.zip"
 
-    # Prepare a temporary directory for storing processed JSON
-    tmp_build_directory = tempfile.mkdtemp(prefix="tt-build-")
-
     # List of files to include in the archive, as tuples of (source path, path in the archive).
     files_to_include: list[tuple[str, str]] = []
-    files_to_remove_from_archive: list[str] = []
+    files_to_remove_from_archive: set[str] = set()
+    # List of JSON files to optimize, as tuples of (source path, path in the archive).
+    json_files_to_optimize: list[tuple[str, str]] = []
+    # List of already processed files, as tuples of (source path, path in the archive, contents).
+    contents_to_include: list[tuple[str, str, str]] = []
+
+    ignored_directories = set(config.ignored_directories)
+    ignored_extensions = tuple(config.ignored_extensions)
 
     # Go over each file, optimize it and put it in a zip
-    for dirname, _, files in os.walk(config.input_directory):
+    for dirname, dirs, files in os.walk(config.input_directory):
+        # Prune ignored directories, so they are never walked into
+        kept_dirs: list[str] = []
+        for directory in dirs:
+            src_abs_dir_path = os.path.join(dirname, directory)
+            if directory in ignored_directories:
+                logger.info(f"Ignoring directory: {src_abs_dir_path}")
+                continue
+            if config.exclude_ignored_items and directory.startswith((".", "_")):
+                logger.info(f"Ignoring directory starting with . or _: {src_abs_dir_path}")
+                continue
+            kept_dirs.append(directory)
+        dirs[:] = kept_dirs
+
+        # Get relative path of the directory to the input directory, so we can preserve the folder structure in the archive
+        rel_dirname = os.path.relpath(dirname, config.input_directory)
+        if rel_dirname == os.curdir:
+            rel_dirname = ""
+
         for filename in files:
             # Get absolute path of the file
             src_abs_file_path = os.path.join(dirname, filename)
-            # Get relative path of the file to the input directory, so we can preserve the folder structure in the archive
-            src_rel_file_path = os.path.relpath(os.path.join(dirname, filename), config.input_directory)
-            # Path where the processed file will be stored temporarily before being added to the archive
-            temp_file_path = os.path.join(tmp_build_directory, src_rel_file_path)
+            # Get relative path of the file to the input directory
+            src_rel_file_path = os.path.join(rel_dirname, filename)
 
             # Ignore files with certain extensions
-            if any(filename.endswith(ext) for ext in config.ignored_extensions):
+            if filename.endswith(ignored_extensions):
                 logger.info(f"Ignoring file with extension: {src_abs_file_path}")
                 continue
 
-            # Ignore files and directories starting with . or _ if the config option is enabled
-            if config.exclude_ignored_items and (filename.startswith(".") or filename.startswith("_") or any(part.startswith(".") or part.startswith("_") for part in src_rel_file_path.split(os.sep))):
-                logger.info(f"Ignoring file or directory starting with . or _: {src_abs_file_path}")
-                continue
-
-            # Ignore files in ignored directories
-            if any(ignored_dir in src_rel_file_path.split(os.sep) for ignored_dir in config.ignored_directories):
-                logger.info(f"Ignoring file in ignored directory: {src_abs_file_path}")
+            # Ignore files starting with . or _ if the config option is enabled
+            if config.exclude_ignored_items and filename.startswith((".", "_")):
+                logger.info(f"Ignoring file starting with . or _: {src_abs_file_path}")
                 continue
 
-            # Create all missing directories of the relative path in temp build directory
-            temp_file_dir = os.path.dirname(temp_file_path)
-            if not os.path.exists(temp_file_dir):
-                os.makedirs(temp_file_dir)
-                logger.debug(f"Created missing temp directory: {temp_file_dir}")
-
             # If it's a plugin.manifest file and we're in plugin store mode, we can remove thumbnail
             # as the manifest is actually not used in the plugin store and the thumbnail is just a waste of space
             if src_rel_file_path == "plugin.manifest" and config.output_format == OutputFormat.STORE:
@@ -174,41 +308,35 @@ def create_archive(
                     # Mark thumbnail for removal from archive
                     thumbnail_path = os.path.join(config.input_directory, manifest["thumbnail"])
                     if os.path.exists(thumbnail_path):
-                        files_to_remove_from_archive.append(thumbnail_path)
+                        files_to_remove_from_archive.add(thumbnail_path)
+                        logger.info(f"Marked thumbnail for removal from archive: {thumbnail_path}")
                     del manifest["thumbnail"]
                     logger.info("Removed thumbnail from plugin.manifest")
-                with open(temp_file_path, "w") as f:
-                    json.dump(manifest, f, separators=(',', ':'))
-                files_to_include.append((temp_file_path, src_rel_file_path))
+                contents_to_include.append((src_abs_file_path, src_rel_file_path, _json_dumps(manifest)))
                 continue
 
             # If it's a JSON file, do some manual optimizations
+            # These are processed in parallel once all files have been collected
             if filename.endswith('.json'):
-                logger.info(f"Optimizing JSON file: {src_abs_file_path}")
-                in_file = open(src_abs_file_path, mode="rb")
-                out_file = open(temp_file_path, mode="w")
-                _ = out_file.write(optimize_json(config, in_file))
-                out_file.close()
-                in_file.close()
-                files_to_include.append((temp_file_path, src_rel_file_path))
+                json_files_to_optimize.append((src_abs_file_path, src_rel_file_path))
                 continue
             files_to_include.append((src_abs_file_path, src_rel_file_path))
 
+    # Files marked for removal might have been collected before being marked, so filter them out now
+    files_to_include = [x for x in files_to_include if x[0] not in files_to_remove_from_archive]
 
-    # Open the zip file for writing and add all the files to it, preserving the folder structure
-    zf = zipfile.ZipFile(os.path.join(config.output_directory, archive_name), "w")
-    for src_path, dst_path in files_to_include:
-        if src_path in files_to_remove_from_archive:
-            logger.info(f"Skipping file marked for removal: {src_path}")
-            continue
-        zf.write(filename=src_path, arcname=dst_path)
-        logger.info(f"Added file to archive: {dst_path}")
-    zf.close()
-
-    # Clean up temporary build directory
-    shutil.rmtree(tmp_build_directory)
+    archive_path = os.path.join(config.output_directory, archive_name)
+    # Write the archive under a temporary name first, so a failed build leaves no incomplete archive behind
+    partial_archive_path = f"{archive_path}.part"
+    try:
+        write_archive(config, partial_archive_path, contents_to_include, files_to_include, json_files_to_optimize)
+    except BaseException:
+        if os.path.exists(partial_archive_path):
+            os.remove(partial_archive_path)
+        raise
+    os.replace(partial_archive_path, archive_path)
 
-    return os.path.join(config.output_directory, archive_name)
+    return archive_path
 
 
 
@@ -252,16 +380,15 @@ def main():
         sys.exit(1)
     
     # Read manifest and check if it's a valid JSON object
-    with open(manifest_path, "r") as f:
-        manifest = json.load(f)
+    with open(manifest_path, "rb") as f:
+        manifest = _json_loads(f.read().decode("utf-8"))
         if not isinstance(manifest, dict):
             logger.error(f"Manifest file {manifest_path} should be a JSON object.")
             sys.exit(1)
 
     # Create output directory if it doesn't exist
     output_dir: str = os.path.abspath(args.output_directory)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
     
     config = Config(
         input_directory=plugin_dir,